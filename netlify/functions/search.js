@@ -1,18 +1,95 @@
 const fs = require('fs');
 const path = require('path');
+const zlib = require('zlib');
+
+const DATA_DIR = path.join(__dirname, '../../data');
+
+// Read a JSON data file, or the .gz/.zst copy preprocess.py writes with
+// --compress. zstd needs a Node version whose zlib supports it.
+function readDataJson(name) {
+  const dataPath = path.join(DATA_DIR, name);
+  if (fs.existsSync(dataPath)) {
+    return JSON.parse(fs.readFileSync(dataPath, 'utf-8'));
+  }
+  if (fs.existsSync(`${dataPath}.gz`)) {
+    return JSON.parse(zlib.gunzipSync(fs.readFileSync(`${dataPath}.gz`)).toString('utf-8'));
+  }
+  if (fs.existsSync(`${dataPath}.zst`)) {
+    if (!zlib.zstdDecompressSync) {
+      throw new Error(`${name}.zst needs a Node.js runtime with zstd support in zlib`);
+    }
+    return JSON.parse(zlib.zstdDecompressSync(fs.readFileSync(`${dataPath}.zst`)).toString('utf-8'));
+  }
+  return null;
+}
 
 // Load commentary data
 let commentaryData = null;
 
 function loadData() {
   if (!commentaryData) {
-    const dataPath = path.join(__dirname, '../../data/commentary.json');
-    const raw = fs.readFileSync(dataPath, 'utf-8');
-    commentaryData = JSON.parse(raw);
+    commentaryData = readDataJson('commentary.json');
+    if (!commentaryData) {
+      throw new Error('commentary.json not found');
+    }
   }
   return commentaryData;
 }
 
+// Load the term -> [[docIndex, tf], ...] index (absent for older data)
+let postings = null;
+let postingTerms = null;
+
+function loadPostings() {
+  if (postings === null) {
+    postings = readDataJson('postings.json') || {};
+    postingTerms = Object.keys(postings);
+  }
+  return postings;
+}
+
+// Document text lives in data/text/<id>.txt and is read on first use
+const textCache = new Map();
+
+function loadText(doc) {
+  if (doc.text !== undefined) {
+    return doc.text; // Older commentary.json with embedded text
+  }
+  if (!textCache.has(doc.id)) {
+    const textPath = path.join(DATA_DIR, 'text', `${doc.id}.txt`);
+    textCache.set(doc.id, fs.readFileSync(textPath, 'utf-8'));
+  }
+  return textCache.get(doc.id);
+}
+
+// Indexes of documents that could contain the keyword: every term in the
+// keyword must occur inside some indexed term of the document. Returns null
+// when the index can't narrow the search, so every document is scanned.
+function candidateDocs(keyword) {
+  const tokens = keyword.toLowerCase().match(/[\p{L}\p{N}]+/gu);
+  const index = loadPostings();
+  if (!tokens || postingTerms.length === 0) {
+    return null;
+  }
+
+  let candidates = null;
+  for (const token of new Set(tokens)) {
+    const docs = new Set();
+    for (const term of postingTerms) {
+      if (term.includes(token)) {
+        for (const [docIndex] of index[term]) {
+          docs.add(docIndex);
+        }
+      }
+    }
+    candidates = candidates ? new Set([...candidates].filter(d => docs.has(d))) : docs;
+    if (candidates.size === 0) {
+      break;
+    }
+  }
+  return candidates;
+}
+
 // Book code lookup (name/abbreviation -> code)
 const BOOK_CODES = {
   'preface': '00',
@@ -148,14 +225,23 @@ function search(keyword, bookFilter, maxResults = 50) {
 
   const bookCode = getBookCode(bookFilter);
   const regex = new RegExp(keyword.replace(/[.*+?^${}()|[\]\\]/g, '\\$&'), 'gi');
+  const candidates = candidateDocs(keyword);
+
+  for (let i = 0; i < data.documents.length; i++) {
+    const doc = data.documents[i];
 
-  for (const doc of data.documents) {
     // Filter by book if specified
     if (bookCode && doc.book_code !== bookCode) {
       continue;
     }
 
-    const matches = doc.text.match(regex);
+    // Skip documents the index rules out before reading their text
+    if (candidates && !candidates.has(i)) {
+      continue;
+    }
+
+    const text = loadText(doc);
+    const matches = text.match(regex);
     if (matches && matches.length > 0) {
       results.push({
         id: doc.id,
@@ -163,7 +249,7 @@ function search(keyword, bookFilter, maxResults = 50) {
         book: doc.book,
         book_code: doc.book_code,
         count: matches.length,
-        contexts: getContext(doc.text, keyword)
+        contexts: getContext(text, keyword)
       });
 
       if (results.length >= maxResults) {
@@ -175,6 +261,20 @@ function search(keyword, bookFilter, maxResults = 50) {
   return results;
 }
 
+// Expand a compact reference ({ b, c, v }) into the shape the browse view uses
+function expandRef(ref, books) {
+  if (ref.book) {
+    return ref; // Already expanded (older commentary.json)
+  }
+  const book = books[ref.b] || 'Unknown';
+  return {
+    book,
+    chapter: ref.c,
+    verses: ref.v,
+    display: `${book} ${ref.c}` + (ref.v ? `:${ref.v}` : '')
+  };
+}
+
 function getReferences(bookFilter, chapter) {
   const data = loadData();
   const bookCode = getBookCode(bookFilter);
@@ -197,7 +297,7 @@ function getReferences(bookFilter, chapter) {
     title: doc.title,
     book: doc.book,
     chapter: doc.chapter,
-    references: doc.references || []
+    references: (doc.references || []).map(r => ({ ...r, ref: expandRef(r.ref, data.books) }))
   };
 }
 
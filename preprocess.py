@@ -3,15 +3,45 @@
 Preprocess Matthew Henry Commentary HTM files into a searchable JSON format.
 This reduces the data size and speeds up search at runtime.
 Also extracts cross-references with surrounding context.
+
+Outputs, next to the main JSON file:
+  postings.json  term -> [[document index, term frequency], ...]
+  text/<id>.txt  plain text of each document, loaded lazily by search
+
+With --compress gzip|zstd the JSON files are written as .json.gz/.json.zst.
 """
 
 import os
 import re
+import gzip
 import json
 import argparse
-from html.parser import HTMLParser
+import multiprocessing
+from array import array
+from collections import Counter
+from html import unescape
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as FastHTMLParser
+except ImportError:
+    FastHTMLParser = None
+
+try:
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # Book codes mapping
 BOOKS = {
     '00': 'Preface',
@@ -32,6 +62,9 @@ BOOKS = {
     '62': '1 John', '63': '2 John', '64': '3 John', '65': 'Jude', '66': 'Revelation',
 }
 
+# Reverse lookup: full book name -> book code
+BOOK_NAME_CODES = {name: code for code, name in BOOKS.items()}
+
 # Mapping for passage abbreviations to full book names
 PASSAGE_BOOK_MAP = {
     'ge': 'Genesis', 'gen': 'Genesis',
@@ -102,245 +135,404 @@ PASSAGE_BOOK_MAP = {
     're': 'Revelation', 'rev': 'Revelation',
 }
 
+# Passage abbreviation -> book code, so parsing needs a single lookup
+PASSAGE_BOOK_CODES = {abbr: BOOK_NAME_CODES[name] for abbr, name in PASSAGE_BOOK_MAP.items()}
+
+
+# Markup removal patterns, compiled once and shared by every file. HTML is
+# kept as raw UTF-8 bytes and only the extracted text is decoded.
+_SCRIPT_RE = re.compile(rb'<script[^>]*>.*?</script>', re.DOTALL | re.IGNORECASE)
+_STYLE_RE = re.compile(rb'<style[^>]*>.*?</style>', re.DOTALL | re.IGNORECASE)
+_TAG_RE = re.compile(rb'<[^>]+>')
+# Text-level, so it also collapses the non-breaking spaces &nbsp; decodes to
+_WS_RE = re.compile(r'\s+')
+# Index terms: runs of letters/digits, matching /[\p{L}\p{N}]+/u in search.js
+_TERM_RE = re.compile(r'[^\W_]+')
+
+# Per-file and per-reference patterns
+_TITLE_SCAN_BYTES = 2048
+_PASSAGE_RE = re.compile(r'(\d?\s*[A-Za-z]+)\s*(\d+):?([\d,\-]*)')
+_REF_LINK_RE = re.compile(rb'<A\s+HREF="[^"]*passage=([^"&]+)"[^>]*>([^<]+)</A>', re.IGNORECASE)
 
-class HTMLTextExtractor(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self.text_parts = []
-        self.in_script = False
-        self.in_style = False
+# Context windows: script/style block edges, and the markup around the text
+_BLOCK_END_RE = re.compile(rb'</(?:script|style)\s*>', re.IGNORECASE)
+_BLOCK_START_RE = re.compile(rb'<(?:script|style)\b', re.IGNORECASE)
+# One leading whitespace run plus tag or script/style block; text_bounds()
+# applies it repeatedly rather than nesting it under * to stay linear
+_LEADING_MARKUP_RE = re.compile(rb'\s*(?:<(script|style)\b[^>]*>.*?</\1\s*>|<[^>]+>)',
+                                re.DOTALL | re.IGNORECASE)
+_WHITESPACE_BYTES = b' \t\r\n\f\v'
+_EDGE_SCAN_BYTES = 4096
+_WORD_BREAKS = b' \t\r\n<>'
 
-    def handle_starttag(self, tag, attrs):
-        if tag == 'script':
-            self.in_script = True
-        elif tag == 'style':
-            self.in_style = True
 
-    def handle_endtag(self, tag):
-        if tag == 'script':
-            self.in_script = False
-        elif tag == 'style':
-            self.in_style = False
+def strip_html_regex(html_content):
+    text = _SCRIPT_RE.sub(b'', html_content)
+    text = _STYLE_RE.sub(b'', text)
+    return unescape(_TAG_RE.sub(b' ', text).decode('utf-8', 'ignore'))
 
-    def handle_data(self, data):
-        if not self.in_script and not self.in_style:
-            self.text_parts.append(data)
 
-    def get_text(self):
-        return ' '.join(self.text_parts)
+_LXML_PARSER = lxml_html.HTMLParser(encoding='utf-8') if lxml_html is not None else None
 
 
 def strip_html(html_content):
-    parser = HTMLTextExtractor()
-    try:
-        parser.feed(html_content)
-        return parser.get_text()
-    except:
-        text = re.sub(r'<script[^>]*>.*?</script>', '', html_content, flags=re.DOTALL | re.IGNORECASE)
-        text = re.sub(r'<style[^>]*>.*?</style>', '', text, flags=re.DOTALL | re.IGNORECASE)
-        text = re.sub(r'<[^>]+>', '', text)
-        return text
+    # Try each available parser in turn, falling back to the regex pipeline
+    if FastHTMLParser is not None:
+        try:
+            tree = FastHTMLParser(html_content)
+            for tag in tree.css('script, style'):
+                tag.decompose()
+            return tree.text(separator=' ')
+        except Exception:
+            pass
+    if lxml_html is not None:
+        try:
+            doc = lxml_html.fromstring(html_content, parser=_LXML_PARSER)
+            for bad in doc.xpath('//script|//style'):
+                bad.drop_tree()
+            # Join text nodes with a space so adjacent blocks don't run together
+            return ' '.join(doc.itertext())
+        except Exception:
+            pass
+    return strip_html_regex(html_content)
 
 
 def get_title_from_html(html_content):
-    match = re.search(r'<TITLE[^>]*>(.*?)</TITLE>', html_content, re.IGNORECASE | re.DOTALL)
-    if match:
-        title = match.group(1).strip()
+    # The title sits in the first few hundred bytes, so only scan the head
+    head = html_content[:_TITLE_SCAN_BYTES].lower()
+    start = head.find(b'<title')
+    if start != -1:
+        start = head.find(b'>', start) + 1
+    end = html_content.find(b'</', start) if start > 0 else -1
+    if end != -1:
+        title = html_content[start:end].decode('utf-8', 'ignore').strip()
         # Clean up the title
         title = title.replace("Matthew Henry's Complete Commentary on the Whole Bible ", "")
         return title
     return "Unknown"
 
 
-def get_book_code(filename):
-    """Extract book code from filename like MHC01001.HTM -> 01"""
-    match = re.match(r'MHC(\d{2})', filename)
-    if match:
-        return match.group(1)
-    return '00'
-
-
-def get_chapter_from_filename(filename):
-    """Extract chapter number from filename like MHC19001.HTM -> 1"""
-    match = re.match(r'MHC\d{2}(\d{3})\.HTM', filename, re.IGNORECASE)
-    if match:
-        return int(match.group(1))
-    return 0
+def parse_filename(filename):
+    """Extract book code and chapter from filename like MHC19001.HTM -> ('19', 1)"""
+    book_code = filename[3:5]
+    chapter = filename[5:8]
+    return (book_code if book_code.isdigit() else '00',
+            int(chapter) if chapter.isdigit() else 0)
 
 
 def parse_passage_ref(passage_str):
-    """Parse a passage string like 'Ps+1:1-3' or 'Lu+23:51' into structured data."""
+    """Parse a passage string like 'Ps+1:1-3' or 'Lu+23:51' into {'b': '19', 'c': 1, 'v': '1-3'}."""
     passage_str = passage_str.replace('+', ' ').strip()
 
     # Match patterns like "Ps 1:1-3", "Lu 23:51", "1Co 6:2"
-    match = re.match(r'(\d?\s*[A-Za-z]+)\s*(\d+):?([\d,\-]*)', passage_str)
+    match = _PASSAGE_RE.match(passage_str)
     if not match:
         return None
 
-    book_abbr = match.group(1).lower().replace(' ', '')
-    chapter = match.group(2)
-    verses = match.group(3) if match.group(3) else ''
-
-    book_name = PASSAGE_BOOK_MAP.get(book_abbr)
-    if not book_name:
+    book_code = PASSAGE_BOOK_CODES.get(match.group(1).lower().replace(' ', ''))
+    if book_code is None:
         return None
 
+    # Compact form: the book is a code into the top-level 'books' table
     return {
-        'book': book_name,
-        'chapter': int(chapter),
-        'verses': verses,
-        'display': f"{book_name} {chapter}" + (f":{verses}" if verses else "")
+        'b': book_code,
+        'c': int(match.group(2)),
+        'v': match.group(3)
     }
 
 
+def _starts_mid_tag(fragment):
+    close = fragment.find(b'>')
+    return close != -1 and fragment.find(b'<', 0, close) == -1
+
+
+def _ends_mid_tag(fragment):
+    open_ = fragment.rfind(b'<')
+    return open_ != -1 and fragment.find(b'>', open_) == -1
+
+
+def _splits_word(html_content, pos):
+    """Whether cutting the raw HTML at pos falls between two non-space characters."""
+    edge = html_content[pos - 1:pos + 1]
+    return len(edge) == 2 and edge[0] not in _WORD_BREAKS and edge[1] not in _WORD_BREAKS
+
+
+def text_bounds(html_content):
+    """Raw offsets where the document's text starts and ends, ignoring surrounding markup."""
+    start = 0
+    while True:
+        match = _LEADING_MARKUP_RE.match(html_content, start, _EDGE_SCAN_BYTES)
+        if not match:
+            break
+        start = match.end()
+    while start < len(html_content) and html_content[start] in _WHITESPACE_BYTES:
+        start += 1
+
+    # Walk back from the end, peeling off whitespace and closing markup
+    floor = max(0, len(html_content) - _EDGE_SCAN_BYTES)
+    tail = html_content[floor:].lower()
+    end = len(tail)
+    while True:
+        while end > 0 and tail[end - 1] in _WHITESPACE_BYTES:
+            end -= 1
+        if end == 0 or tail[end - 1] != ord('>'):
+            break
+        open_ = tail.rfind(b'<', 0, end)
+        if open_ == -1:
+            break
+        block = -1
+        if tail.startswith(b'</script', open_):
+            block = tail.rfind(b'<script', 0, open_)
+        elif tail.startswith(b'</style', open_):
+            block = tail.rfind(b'<style', 0, open_)
+        end = block if block != -1 else open_
+    return start, floor + end
+
+
+def strip_html_fragment(fragment):
+    """Strip markup from a raw HTML slice, dropping tags cut off at either edge."""
+    if _starts_mid_tag(fragment):
+        fragment = fragment[fragment.find(b'>') + 1:]
+    if _ends_mid_tag(fragment):
+        fragment = fragment[:fragment.rfind(b'<')]
+    return _WS_RE.sub(' ', strip_html_regex(fragment)).strip()
+
+
 def extract_references_with_context(html_content, context_chars=200):
     """Extract all Bible references from HTML with surrounding context."""
     references = []
 
-    # Pattern for Bible reference links
-    pattern = r'<A\s+HREF="[^"]*passage=([^"&]+)"[^>]*>([^<]+)</A>'
-
-    # Create plain text version for context
-    text_content = strip_html(html_content)
-    text_content = re.sub(r'\s+', ' ', text_content).strip()
+    # Raw HTML to scan on each side; markup makes it longer than the text it yields
+    window = context_chars * 3
+    text_start, text_end = text_bounds(html_content)
 
-    for match in re.finditer(pattern, html_content, re.IGNORECASE):
-        passage_param = match.group(1)
-        display_text = match.group(2).strip()
+    for match in _REF_LINK_RE.finditer(html_content):
+        passage_param = match.group(1).decode('utf-8', 'ignore')
+        display_text = match.group(2).decode('utf-8', 'ignore').strip()
 
         parsed = parse_passage_ref(passage_param)
         if not parsed:
             continue
 
-        # Find context around this reference
-        display_clean = re.sub(r'\s+', ' ', strip_html(display_text)).strip()
-        pos = text_content.find(display_clean)
-
-        if pos != -1:
-            start = max(0, pos - context_chars)
-            end = min(len(text_content), pos + len(display_clean) + context_chars)
-
-            # Extend to word boundaries
-            while start > 0 and text_content[start] not in ' .\n':
-                start -= 1
-            while end < len(text_content) and text_content[end] not in ' .\n':
-                end += 1
-
-            context = text_content[start:end].strip()
-            if start > 0:
-                context = '...' + context
-            if end < len(text_content):
-                context = context + '...'
-        else:
-            context = display_text
+        # Strip only the HTML around this link rather than the whole document.
+        # Windows never reach into a script/style block: start after the last
+        # one closing before the link, stop at the first one opening after it.
+        window_start = max(0, match.start() - window)
+        for block_end in _BLOCK_END_RE.finditer(html_content, window_start, match.start()):
+            window_start = block_end.end()
+        fragment = html_content[window_start:match.start()]
+        partial_before = _splits_word(html_content, window_start) and not _starts_mid_tag(fragment)
+        before = strip_html_fragment(fragment)
+
+        window_end = min(len(html_content), match.end() + window)
+        block_start = _BLOCK_START_RE.search(html_content, match.end(), window_end)
+        if block_start:
+            window_end = block_start.start()
+        fragment = html_content[match.end():window_end]
+        partial_after = _splits_word(html_content, window_end) and not _ends_mid_tag(fragment)
+        after = strip_html_fragment(fragment)
+
+        # Trim to context_chars, dropping any word cut off at the edge
+        truncated_before = len(before) > context_chars
+        if truncated_before:
+            cut = len(before) - context_chars
+            partial_before = before[cut - 1] != ' ' and before[cut] != ' '
+            before = before[cut:]
+        if partial_before:
+            before = before.split(' ', 1)[1] if ' ' in before else ''
+        truncated_after = len(after) > context_chars
+        if truncated_after:
+            partial_after = after[context_chars - 1] != ' ' and after[context_chars] != ' '
+            after = after[:context_chars]
+        if partial_after:
+            after = after.rsplit(' ', 1)[0] if ' ' in after else ''
+
+        display_clean = _WS_RE.sub(' ', unescape(display_text))
+        context = ' '.join(part for part in (before.strip(), display_clean, after.strip()) if part)
+        if truncated_before or window_start > text_start:
+            context = '...' + context
+        if truncated_after or window_end < text_end:
+            context = context + '...'
 
         references.append({
             'ref': parsed,
-            'display': display_text,
             'context': context
         })
 
     return references
 
 
-def build_book_structure(htm_files):
+def build_book_structure(filenames):
     """Build a structure of books and their available chapters from filenames."""
     structure = {}
 
-    for filepath in htm_files:
-        book_code = get_book_code(filepath.name)
-        chapter = get_chapter_from_filename(filepath.name)
+    for filename in filenames:
+        book_code, chapter = parse_filename(filename)
 
         if book_code not in structure:
             structure[book_code] = {
                 'name': BOOKS.get(book_code, 'Unknown'),
-                'chapters': []
+                'chapters': set()
             }
 
-        if chapter > 0 and chapter not in structure[book_code]['chapters']:
-            structure[book_code]['chapters'].append(chapter)
+        if chapter > 0:
+            structure[book_code]['chapters'].add(chapter)
 
     # Sort chapters for each book
     for book_code in structure:
-        structure[book_code]['chapters'].sort()
+        structure[book_code]['chapters'] = sorted(structure[book_code]['chapters'])
 
     return structure
 
 
+def dumps(obj):
+    """Encode obj as compact UTF-8 JSON, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def open_output(path, compress):
+    """Open a JSON output for binary writing, compressing as it streams.
+
+    Copies of the same file in the other formats are removed, since the
+    search function serves whichever one it finds first.
+    Returns the file object and the path actually written.
+    """
+    suffix = {'gzip': '.gz', 'zstd': '.zst'}.get(compress, '')
+    for other in ('', '.gz', '.zst'):
+        if other != suffix:
+            path.with_name(path.name + other).unlink(missing_ok=True)
+
+    path = path.with_name(path.name + suffix)
+    if compress == 'gzip':
+        return gzip.open(path, 'wb'), path
+    if compress == 'zstd':
+        cctx = zstandard.ZstdCompressor(level=19, threads=-1)
+        return cctx.stream_writer(open(path, 'wb'), closefd=True), path
+    return open(path, 'wb'), path
+
+
+def process_file(filepath):
+    """Return (document record, plain text, term counts) for an HTM file path, or None on failure."""
+    filename = os.path.basename(filepath)
+    try:
+        with open(filepath, 'rb') as f:
+            html_content = f.read()
+
+        title = get_title_from_html(html_content)
+        text = strip_html(html_content)
+        text = _WS_RE.sub(' ', text).strip()
+
+        book_code, chapter = parse_filename(filename)
+        book_name = BOOKS.get(book_code, 'Unknown')
+
+        # Extract cross-references with context
+        references = extract_references_with_context(html_content)
+
+        return {
+            'id': filename,
+            'title': title,
+            'book_code': book_code,
+            'book': book_name,
+            'chapter': chapter,
+            'references': references
+        }, text, Counter(_TERM_RE.findall(text.lower()))
+
+    except Exception as e:
+        print(f"Error processing {filepath}: {e}")
+        return None
+
+
 def main():
     parser = argparse.ArgumentParser(description='Preprocess Matthew Henry Commentary')
     parser.add_argument('-i', '--input', default='/Users/stanleytan/matthew_henry',
                         help='Directory containing HTM files')
     parser.add_argument('-o', '--output', default='./data/commentary.json',
                         help='Output JSON file')
+    parser.add_argument('--compress', choices=['none', 'gzip', 'zstd'], default='none',
+                        help='Write the JSON outputs gzip- or zstd-compressed '
+                             '(zstd needs a Node.js runtime with zlib zstd support to serve)')
     args = parser.parse_args()
+    if args.compress == 'zstd' and zstandard is None:
+        parser.error('--compress zstd requires the zstandard package')
 
     # Books to exclude (Acts 44 through Revelation 66)
     EXCLUDED_BOOKS = set(str(i).zfill(2) for i in range(44, 67))
 
-    all_htm_files = sorted(Path(args.input).glob('MHC*.HTM'))
+    with os.scandir(args.input) as it:
+        all_htm_files = sorted(
+            (e for e in it
+             if e.name.startswith('MHC') and e.name.upper().endswith('.HTM') and e.is_file()),
+            key=lambda e: e.name)
     # Filter out excluded books
-    htm_files = [f for f in all_htm_files if get_book_code(f.name) not in EXCLUDED_BOOKS]
+    htm_files = [e for e in all_htm_files if parse_filename(e.name)[0] not in EXCLUDED_BOOKS]
     print(f"Excluding books 45-66 (Romans-Revelation): {len(all_htm_files) - len(htm_files)} files removed")
 
-    documents = []
+    doc_count = 0
     total_refs = 0
 
     print(f"Processing {len(htm_files)} files...")
 
     # Build book/chapter structure from filenames
-    book_structure = build_book_structure(htm_files)
+    book_structure = build_book_structure([e.name for e in htm_files])
     print(f"Found {len(book_structure)} books with chapters")
 
-    for i, filepath in enumerate(htm_files):
-        try:
-            with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-                html_content = f.read()
-
-            title = get_title_from_html(html_content)
-            text = strip_html(html_content)
-            text = re.sub(r'\s+', ' ', text).strip()
-
-            book_code = get_book_code(filepath.name)
-            book_name = BOOKS.get(book_code, 'Unknown')
-            chapter = get_chapter_from_filename(filepath.name)
-
-            # Extract cross-references with context
-            references = extract_references_with_context(html_content)
-            total_refs += len(references)
-
-            documents.append({
-                'id': filepath.name,
-                'title': title,
-                'book_code': book_code,
-                'book': book_name,
-                'chapter': chapter,
-                'text': text,
-                'references': references
-            })
+    output_path = Path(args.output)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    text_dir = output_path.parent / 'text'
+    text_dir.mkdir(exist_ok=True)
+    postings_path = output_path.parent / 'postings.json'
+    # term -> (doc indexes, term frequencies) as packed arrays; a list pair per
+    # hit costs several times more memory than the corpus text itself
+    postings = {}
+
+    # Stream documents straight to disk, one per line, instead of holding
+    # the whole corpus in memory. imap keeps them in filename order.
+    f, output_file = open_output(output_path, args.compress)
+    with f, multiprocessing.Pool() as pool:
+        f.write(b'{"books":' + dumps(BOOKS)
+                + b',"bookStructure":' + dumps(book_structure)
+                + b',"documents":[')
+
+        # DirEntry objects don't pickle, so workers get plain path strings
+        htm_paths = [e.path for e in htm_files]
+        for i, result in enumerate(pool.imap(process_file, htm_paths, chunksize=16)):
+            if result is not None:
+                doc, text, term_counts = result
+                (text_dir / f"{doc['id']}.txt").write_text(text, encoding='utf-8')
+                for term, tf in term_counts.items():
+                    entry = postings.get(term)
+                    if entry is None:
+                        entry = postings[term] = (array('I'), array('I'))
+                    entry[0].append(doc_count)
+                    entry[1].append(tf)
+
+                f.write(b',\n' if doc_count else b'\n')
+                f.write(dumps(doc))
+                doc_count += 1
+                total_refs += len(doc['references'])
 
             if (i + 1) % 100 == 0:
                 print(f"  Processed {i + 1}/{len(htm_files)} files...")
 
-        except Exception as e:
-            print(f"Error processing {filepath}: {e}")
-
-    # Write main output
-    output_path = Path(args.output)
-    output_path.parent.mkdir(parents=True, exist_ok=True)
+        f.write(b'\n]}')
 
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump({
-            'books': BOOKS,
-            'bookStructure': book_structure,
-            'documents': documents
-        }, f)
+    f, postings_file = open_output(postings_path, args.compress)
+    with f:
+        # Expand one term at a time so the JSON lists never exist all at once
+        f.write(b'{')
+        for n, (term, (doc_indexes, tfs)) in enumerate(postings.items()):
+            f.write((b',' if n else b'') + dumps(term) + b':'
+                    + dumps([[d, tf] for d, tf in zip(doc_indexes, tfs)]))
+        f.write(b'}')
 
     # Calculate size
-    size_mb = output_path.stat().st_size / (1024 * 1024)
-    print(f"\nDone! Created {args.output}")
-    print(f"  {len(documents)} documents")
+    size_mb = output_file.stat().st_size / (1024 * 1024)
+    print(f"\nDone! Created {output_file}")
+    print(f"  {doc_count} documents")
     print(f"  {total_refs} cross-references extracted")
+    print(f"  {len(postings)} index terms in {postings_file}")
     print(f"  {size_mb:.1f} MB")
 
 